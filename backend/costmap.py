@@ -1,11 +1,47 @@
 """
 Traversability cost map generation from segmentation masks
 """
+import base64
 import numpy as np
 from PIL import Image
 import cv2
+from functools import lru_cache
 from typing import Tuple, List, Dict
 
+# Costs are blurred as 16-bit fixed point (OpenCV's SIMD 16U filter path)
+COST_SCALE = 65535
+
+# Kernels at least this large are smoothed with three box passes instead
+BOX_BLUR_MIN_KERNEL = 15
+
+
+@lru_cache(maxsize=8)
+def _cost_lut(class_costs: Tuple[Tuple[int, float], ...]) -> np.ndarray:
+    """
+    Build a class ID -> quantized cost lookup table (unlisted IDs cost 0)
+    """
+    max_id = max((class_id for class_id, _ in class_costs), default=0)
+    lut = np.zeros(max(256, max_id + 1), dtype=np.uint16)
+    for class_id, cost in class_costs:
+        lut[class_id] = round(min(max(cost, 0.0), 1.0) * COST_SCALE)
+    return lut
+
+
+def _smooth_costs(cost_q: np.ndarray, blur_kernel: int) -> np.ndarray:
+    """
+    Gaussian-smooth a uint16 cost grid, using an O(1)-per-pixel
+    triple box blur for large kernels
+    """
+    if blur_kernel < BOX_BLUR_MIN_KERNEL:
+        return cv2.GaussianBlur(cost_q, (blur_kernel, blur_kernel), 0)
+
+    # Match the sigma OpenCV derives for this kernel size
+    sigma = 0.3 * ((blur_kernel - 1) * 0.5 - 1) + 0.8
+    box = int(round(np.sqrt(4 * sigma ** 2 + 1))) | 1
+    for _ in range(3):
+        cost_q = cv2.boxFilter(cost_q, -1, (box, box))
+    return cost_q
+
 
 def generate_cost_map(
     seg_mask: np.ndarray,
@@ -24,18 +60,14 @@ def generate_cost_map(
         - cost_map_img: PIL Image visualization (heatmap)
         - cost_grid: (H, W) float array normalized 0-1
     """
-    h, w = seg_mask.shape
-    cost_grid = np.zeros((h, w), dtype=np.float32)
-
     # Map each class to its traversal cost
-    for cls in terrain_classes:
-        class_id = cls["id"]
-        cost = cls["cost"]
-        cost_grid[seg_mask == class_id] = cost
+    cost_lut = _cost_lut(tuple((cls["id"], cls["cost"]) for cls in terrain_classes))
+    cost_q = cost_lut[seg_mask]
 
     # Apply Gaussian blur to smooth cost transitions
     # This creates gradients around obstacles
-    cost_grid = cv2.GaussianBlur(cost_grid, (blur_kernel, blur_kernel), 0)
+    cost_q = _smooth_costs(cost_q, blur_kernel)
+    cost_grid = cost_q.astype(np.float32) / COST_SCALE
 
     # Normalize to [0, 1]
     cost_grid = np.clip(cost_grid, 0, 1)
@@ -71,34 +103,48 @@ def create_cost_heatmap(cost_grid: np.ndarray) -> Image.Image:
     return Image.fromarray(heatmap_custom)
 
 
+def apply_terrain_colormap_branchless(cost_grid: np.ndarray) -> np.ndarray:
+    """
+    Branchless reference implementation of the terrain colormap
+    Each channel is a clipped linear ramp of cost, evaluated with plain
+    ufunc passes (no boolean-mask scatter writes). Works on any shape.
+    """
+    cost = np.clip(cost_grid, 0, 1).astype(np.float32, copy=False)
+    above = (cost >= 0.3).astype(np.float32)  # Caution or danger
+    ramp_safe = np.clip(cost / 0.3, 0, 1)
+    ramp_caution = np.clip((cost - 0.3) / 0.3, 0, 1)
+
+    rgb = np.zeros(cost.shape + (3,), dtype=np.uint8)
+    # Red: slight red across the safe zone, full red from caution on
+    np.copyto(rgb[..., 0], 100 * ramp_safe + 155 * above, casting="unsafe")
+    # Green: fades across the safe zone, then again across the caution zone
+    np.copyto(rgb[..., 1], 255 * (1 - ramp_safe + above * (1 - ramp_caution)), casting="unsafe")
+    return rgb
+
+
+def _build_terrain_lut() -> np.ndarray:
+    """
+    Evaluate the terrain colormap once at 256 evenly spaced cost levels
+    """
+    t = np.arange(256, dtype=np.float32) / 255.0
+    return apply_terrain_colormap_branchless(t)
+
+
+# (256, 3) uint8 RGB lookup table indexed by quantized cost
+TERRAIN_LUT = _build_terrain_lut()
+
+
 def apply_terrain_colormap(cost_grid: np.ndarray) -> np.ndarray:
     """
     Custom terrain-aware colormap
     0.0 - 0.3: Green (safe)
     0.3 - 0.6: Yellow (caution)
     0.6 - 1.0: Red (danger)
-    """
-    h, w = cost_grid.shape
-    rgb = np.zeros((h, w, 3), dtype=np.uint8)
-
-    # Safe zone (green)
-    safe = cost_grid < 0.3
-    rgb[safe, 1] = (255 * (1 - cost_grid[safe] / 0.3)).astype(np.uint8)  # Full green
-    rgb[safe, 0] = (100 * (cost_grid[safe] / 0.3)).astype(np.uint8)  # Slight red
-
-    # Caution zone (yellow)
-    caution = (cost_grid >= 0.3) & (cost_grid < 0.6)
-    t = (cost_grid[caution] - 0.3) / 0.3
-    rgb[caution, 0] = (255).astype(np.uint8)  # Red channel
-    rgb[caution, 1] = (255 * (1 - t)).astype(np.uint8)  # Green fades
 
-    # Danger zone (red)
-    danger = cost_grid >= 0.6
-    rgb[danger, 0] = 255
-    rgb[danger, 1] = 0
-    rgb[danger, 2] = 0
-
-    return rgb
+    Costs are quantized to 256 levels and mapped through TERRAIN_LUT.
+    """
+    idx = (np.clip(cost_grid, 0, 1) * 255).astype(np.uint8)
+    return TERRAIN_LUT[idx]
 
 
 def export_cost_grid_ros(cost_grid: np.ndarray, resolution: float = 0.05) -> Dict:
@@ -110,12 +156,15 @@ def export_cost_grid_ros(cost_grid: np.ndarray, resolution: float = 0.05) -> Dic
         resolution: meters per pixel
         
     Returns:
-        Dictionary compatible with ROS nav_msgs/OccupancyGrid
+        Dictionary compatible with ROS nav_msgs/OccupancyGrid. `data` holds the
+        row-major int8 occupancy as base64 raw bytes; decode with
+        np.frombuffer(base64.b64decode(data), np.int8).reshape(height, width)
     """
     h, w = cost_grid.shape
     
     # Convert to int8 occupancy (0-100 scale)
-    occupancy = (cost_grid * 100).astype(np.int8).flatten().tolist()
+    occupancy = (cost_grid * 100).astype(np.int8)
+    data = base64.b64encode(occupancy.tobytes()).decode()
     
     return {
         "header": {
@@ -130,5 +179,6 @@ def export_cost_grid_ros(cost_grid: np.ndarray, resolution: float = 0.05) -> Dic
                 "orientation": {"x": 0.0, "y": 0.0, "z": 0.0, "w": 1.0},
             },
         },
-        "data": occupancy,
+        "data_encoding": "base64-int8",
+        "data": data,
     }
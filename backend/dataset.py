@@ -11,8 +11,10 @@ import argparse
 import os
 import json
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+import cv2
 import numpy as np
 from PIL import Image, ImageFilter, ImageDraw
 
@@ -33,37 +35,76 @@ TERRAIN_CLASSES = [
 NUM_CLASSES = len(TERRAIN_CLASSES)
 ID2RGB   = {c["id"]: c["rgb"]  for c in TERRAIN_CLASSES}
 ID2NAME  = {c["id"]: c["name"] for c in TERRAIN_CLASSES}
+PALETTE  = np.array([c["rgb"] for c in TERRAIN_CLASSES], dtype=np.float32)  # (N, 3)
 
 # ─── Noise Helpers ─────────────────────────────────────────────────────────────
 
 def _pseudo_rand(grid_x: np.ndarray, grid_y: np.ndarray, seed: int) -> np.ndarray:
-    """Deterministic pseudo-random field from 2D grid coords."""
+    """
+    Deterministic pseudo-random field from 2D grid coords.
+
+    `grid_x` (1, W) and `grid_y` (H, 1) broadcast, so the per-axis scaling is
+    done on 1-D ranges and only the sum is materialised at (H, W).
+    """
     r = np.sin(grid_x * (127.1 + seed * 0.07) + grid_y * (311.7 + seed * 0.13)) * 43758.5453
     return r - np.floor(r)
 
 
-def _sine_noise(nx: np.ndarray, nz: np.ndarray, freqs, seed: int) -> np.ndarray:
-    """Sum of sine waves with phase offsets for terrain-like variation."""
+def _sine_noise(
+    nx: np.ndarray, nz: np.ndarray, freqs, seed: int, buf: np.ndarray = None
+) -> np.ndarray:
+    """
+    Sum of sine waves with phase offsets for terrain-like variation.
+
+    Each term is separable, so it is evaluated on the 1-D row `nx` (1, W) and
+    column `nz` (H, 1) and expanded with an outer product.
+    `buf` is an optional (2, H, W) float64 scratch for the sum and each term.
+    """
     rng = np.random.default_rng(seed)
-    acc = np.zeros_like(nx)
+    xs, zs = nx.ravel(), nz.ravel()
+    if buf is None:
+        buf = np.empty((2, zs.size, xs.size))
+    acc, term = buf
+    acc.fill(0)
     for fx, fz, amp in freqs:
         px, pz = rng.uniform(0, 2 * np.pi, 2)
-        acc += amp * np.sin(nx * np.pi * fx + px) * np.cos(nz * np.pi * fz + pz)
+        sin_x = amp * np.sin(xs * np.pi * fx + px)
+        cos_z = np.cos(zs * np.pi * fz + pz)
+        np.multiply.outer(cos_z, sin_x, out=term)
+        acc += term
     return acc
 
 
+def _grid_coords(size: int):
+    """
+    Normalised (X, Z) and integer (I, J) coordinates, each as a broadcastable
+    row (1, size) / column (size, 1) pair instead of a full meshgrid.
+    """
+    ix = np.arange(size)
+    t = ix / (size - 1)
+    return t[None, :], t[:, None], ix[None, :], ix[:, None]
+
+
+def _label_buffer(size: int, fill: int, out: np.ndarray = None) -> np.ndarray:
+    """(size, size) uint8 label map filled with `fill`, reusing `out` if given."""
+    if out is None:
+        return np.full((size, size), fill, dtype=np.uint8)
+    out.fill(fill)
+    return out
+
+
 # ─── Terrain Generators ────────────────────────────────────────────────────────
 
-def gen_desert(size: int, seed: int) -> np.ndarray:
+def gen_desert(
+    size: int, seed: int, out: np.ndarray = None, noise_buf: np.ndarray = None
+) -> np.ndarray:
     """Mostly sand + rock clusters, scattered bush/log, few obstacles."""
-    ix = np.arange(size); iz = np.arange(size)
-    X, Z = np.meshgrid(ix / (size - 1), iz / (size - 1))  # each is (size, size)
-    I, J = np.meshgrid(ix, iz)
+    X, Z, I, J = _grid_coords(size)
 
-    wave = _sine_noise(X, Z, [(3, 2.5, 0.4), (9, 7, 0.2), (16, 12, 0.08)], seed)
+    wave = _sine_noise(X, Z, [(3, 2.5, 0.4), (9, 7, 0.2), (16, 12, 0.08)], seed, noise_buf)
     r    = _pseudo_rand(I + seed, J + seed * 2, seed)
 
-    labels = np.full((size, size), 3, dtype=np.uint8)  # Sand default
+    labels = _label_buffer(size, 3, out)  # Sand default
     labels[wave > 0.45] = 0               # Rock
     labels[(wave > 0.30) & (r > 0.78)] = 1  # Bush
     labels[(wave > 0.22) & (r > 0.90)] = 2  # Log
@@ -72,49 +113,54 @@ def gen_desert(size: int, seed: int) -> np.ndarray:
     return labels
 
 
-def gen_rocky(size: int, seed: int) -> np.ndarray:
+def gen_rocky(
+    size: int, seed: int, out: np.ndarray = None, noise_buf: np.ndarray = None
+) -> np.ndarray:
     """Dense rock with a gravel/sand corridor down the middle."""
-    ix = np.arange(size); iz = np.arange(size)
-    X, Z = np.meshgrid(ix / (size - 1), iz / (size - 1))
-    I, J = np.meshgrid(ix, iz)
+    X, Z, I, J = _grid_coords(size)
 
-    wave = _sine_noise(X, Z, [(5, 4, 0.55), (10, 8, 0.25), (20, 15, 0.1)], seed)
+    wave = _sine_noise(X, Z, [(5, 4, 0.55), (10, 8, 0.25), (20, 15, 0.1)], seed, noise_buf)
     r    = _pseudo_rand(I * 2 + seed, J * 3 + seed, seed)
     dist = np.abs(X - 0.5)  # distance from vertical centre
+    corridor = dist < 0.12
 
-    labels = np.full((size, size), 0, dtype=np.uint8)   # Rock default
+    labels = _label_buffer(size, 0, out)   # Rock default
     labels[wave > 0.38] = 9        # Obstacle
     labels[wave < -0.2] = 8        # Vegetation in valleys
-    labels[dist < 0.12] = 6        # Gravel corridor
+    labels[:, corridor[0]] = 6     # Gravel corridor
     labels[(dist < 0.07) & (r < 0.55)] = 3  # Sand within corridor
-    labels[(dist < 0.12) & (r > 0.86)] = 2  # Logs blocking corridor
+    labels[corridor & (r > 0.86)] = 2  # Logs blocking corridor
     labels[(dist > 0.35) & (r > 0.88)] = 1  # Bush far from corridor
     return labels
 
 
-def gen_mixed(size: int, seed: int) -> np.ndarray:
+def gen_mixed(
+    size: int, seed: int, out: np.ndarray = None, noise_buf: np.ndarray = None
+) -> np.ndarray:
     """All 10 classes – zoned terrain with water, forest, rocks, path."""
-    ix = np.arange(size); iz = np.arange(size)
-    X, Z = np.meshgrid(ix / (size - 1), iz / (size - 1))
-    I, J = np.meshgrid(ix, iz)
+    X, Z, I, J = _grid_coords(size)
 
-    wave = _sine_noise(X, Z, [(4, 3, 0.35), (10, 8, 0.15), (18, 14, 0.06)], seed)
+    wave = _sine_noise(X, Z, [(4, 3, 0.35), (10, 8, 0.15), (18, 14, 0.06)], seed, noise_buf)
     r    = _pseudo_rand(I + seed * 3, J + seed, seed)
 
-    labels = np.full((size, size), 4, dtype=np.uint8)  # Landscape default
+    labels = _label_buffer(size, 4, out)  # Landscape default
 
     # Water zone – bottom-right circle
     dist_water = np.hypot(X - 0.82, Z - 0.82)
-    labels[dist_water < 0.18] = 7         # Water
-    labels[(dist_water >= 0.18) & (dist_water < 0.27)] = 6  # Gravel shore
+    water = dist_water < 0.18
+    labels[water] = 7         # Water
+    labels[~water & (dist_water < 0.27)] = 6  # Gravel shore
 
     # Rock zone – top-right quadrant
-    labels[(X > 0.65) & (Z < 0.35) & (wave > 0.20)] = 0
-    labels[(X > 0.65) & (Z < 0.35) & (wave > 0.35)] = 9
+    top = Z < 0.35
+    rock_zone = top & (X > 0.65)
+    labels[rock_zone & (wave > 0.20)] = 0
+    labels[rock_zone & (wave > 0.35)] = 9
 
     # Vegetation / bush zone – top-left quadrant
-    labels[(X < 0.35) & (Z < 0.35)] = 8
-    labels[(X < 0.35) & (Z < 0.35) & (r > 0.70)] = 1
+    veg_zone = top & (X < 0.35)
+    labels[veg_zone] = 8
+    labels[veg_zone & (r > 0.70)] = 1
 
     # Logs scattered diagonally
     log_diag = np.abs((X - Z)) < 0.04
@@ -136,61 +182,73 @@ def gen_mixed(size: int, seed: int) -> np.ndarray:
     return labels
 
 
-def gen_random(size: int, seed: int) -> np.ndarray:
+def gen_random(
+    size: int, seed: int, out: np.ndarray = None, noise_buf: np.ndarray = None
+) -> np.ndarray:
     """Randomly pick one of the three terrain styles."""
     style = seed % 3
-    if style == 0: return gen_desert(size, seed)
-    if style == 1: return gen_rocky(size, seed)
-    return gen_mixed(size, seed)
+    if style == 0: return gen_desert(size, seed, out, noise_buf)
+    if style == 1: return gen_rocky(size, seed, out, noise_buf)
+    return gen_mixed(size, seed, out, noise_buf)
 
 
 # ─── Augmentation ─────────────────────────────────────────────────────────────
 
+# cv2.rotate codes for k counter-clockwise quarter turns (matches np.rot90)
+_CV2_ROTATE = {
+    1: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    2: cv2.ROTATE_180,
+    3: cv2.ROTATE_90_CLOCKWISE,
+}
+
+
 def augment_image(img: Image.Image, label: np.ndarray, rng: np.random.Generator):
     """Random flips, rotation and slight color jitter (preserves label alignment)."""
+    # cv2 flips/rotations return fresh contiguous arrays (no strided views to copy)
+    arr = np.array(img)
     # Horizontal flip
     if rng.random() > 0.5:
-        img   = img.transpose(Image.FLIP_LEFT_RIGHT)
-        label = np.fliplr(label)
+        arr, label = cv2.flip(arr, 1), cv2.flip(label, 1)
     # Vertical flip
     if rng.random() > 0.5:
-        img   = img.transpose(Image.FLIP_TOP_BOTTOM)
-        label = np.flipud(label)
+        arr, label = cv2.flip(arr, 0), cv2.flip(label, 0)
     # 90° rotation (k ∈ {0,1,2,3})
     k = int(rng.integers(0, 4))
     if k > 0:
-        img   = img.rotate(k * 90)
-        label = np.rot90(label, k)
+        arr, label = cv2.rotate(arr, _CV2_ROTATE[k]), cv2.rotate(label, _CV2_ROTATE[k])
     # Slight color jitter (image only, not label)
     factor = rng.uniform(0.85, 1.15)
-    arr = np.clip(np.array(img).astype(np.float32) * factor, 0, 255).astype(np.uint8)
-    img = Image.fromarray(arr)
-    return img, np.ascontiguousarray(label)
+    arr = np.clip(arr.astype(np.float32) * factor, 0, 255).astype(np.uint8)
+    return Image.fromarray(arr), label
 
 
 # ─── Image Renderer ────────────────────────────────────────────────────────────
 
 def render_terrain(
-    labels: np.ndarray, size: int, rng: np.random.Generator, noise_std: float = 8.0
+    labels: np.ndarray,
+    size: int,
+    rng: np.random.Generator,
+    noise_std: float = 8.0,
+    out: np.ndarray = None,
+    jitter: np.ndarray = None,
 ) -> Image.Image:
     """
     Convert label map → RGB image.
     Adds per-class color jitter + texture noise for realism.
+    `out` (H, W, 3) uint8 and `jitter` (H, W, 3) float32 are optional scratch
+    buffers for the raw pixels and the noise.
     """
     H, W = labels.shape
-    rgb = np.zeros((H, W, 3), dtype=np.uint8)
-    for cid, tc in enumerate(TERRAIN_CLASSES):
-        mask = labels == cid
-        if not mask.any():
-            continue
-        base = np.array(tc["rgb"], dtype=np.float32)
-        # Per-pixel color jitter
-        jitter = rng.normal(0, noise_std, (mask.sum(), 3))
-        pix = np.clip(base + jitter, 0, 255).astype(np.uint8)
-        rgb[mask] = pix
+    rgb = out if out is not None else np.empty((H, W, 3), dtype=np.uint8)
+    # Per-pixel color jitter around the class colour
+    jitter = rng.standard_normal((H, W, 3), dtype=np.float32, out=jitter)
+    jitter *= noise_std
+    jitter += PALETTE[labels]
+    np.clip(jitter, 0, 255, out=jitter)
+    np.copyto(rgb, jitter, casting="unsafe")
 
     img = Image.fromarray(rgb, "RGB")
-    # Slight Gaussian blur to smooth hard edges
+    # Slight Gaussian blur to smooth hard edges (SSE4-accelerated under Pillow-SIMD)
     img = img.filter(ImageFilter.GaussianBlur(radius=0.8))
     if size != H:
         img = img.resize((size, size), Image.BILINEAR)
@@ -199,6 +257,64 @@ def render_terrain(
 
 # ─── Dataset Generation ────────────────────────────────────────────────────────
 
+# Per-process scratch buffers, reused across the samples a worker generates
+_buffers = {}
+
+
+def _scratch(shape, dtype) -> np.ndarray:
+    key = (shape, np.dtype(dtype))
+    if key not in _buffers:
+        _buffers[key] = np.empty(shape, dtype=dtype)
+    return _buffers[key]
+
+
+def _make_one(
+    idx: int,
+    seed_seq: np.random.SeedSequence,
+    split: str,
+    grid: int,
+    img_size: int,
+    augment: bool,
+    out_dir: str,
+) -> int:
+    """Generate, render and save one (image, label) pair. Runs in a worker process."""
+    rng = np.random.default_rng(seed_seq)
+    out = Path(out_dir)
+
+    s = int(rng.integers(0, 2**31))
+    labels = gen_random(
+        grid, s,
+        out=_scratch((grid, grid), np.uint8),
+        noise_buf=_scratch((2, grid, grid), np.float64),
+    )
+    img = render_terrain(
+        labels, img_size, rng,
+        out=_scratch((grid, grid, 3), np.uint8),
+        jitter=_scratch((grid, grid, 3), np.float32),
+    )
+    # Resize labels to match image size (nearest)
+    if img_size != grid:
+        lbl_pil = Image.fromarray(labels, "L").resize(
+            (img_size, img_size), Image.NEAREST
+        )
+        labels = np.array(lbl_pil)
+
+    if augment and split == "train":
+        img, labels = augment_image(img, labels, rng)
+
+    # Fast PNG compression: zlib level 6 (the default) dominates write time
+    stem = f"{idx:06d}"
+    img.save(
+        out / "images" / split / f"{stem}.png",
+        format="PNG", compress_level=1, optimize=False,
+    )
+    ann_path = out / "annotations" / split / f"{stem}.png"
+    # cv2 signals failure by returning False rather than raising
+    if not cv2.imwrite(str(ann_path), labels, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+        raise IOError(f"Failed to write label map {ann_path}")
+    return idx
+
+
 def generate_dataset(
     out_dir: str,
     n: int = 1000,
@@ -207,10 +323,15 @@ def generate_dataset(
     val_split: float = 0.15,
     seed: int = 42,
     augment: bool = True,
+    workers: int = None,
 ):
     """
     Generate `n` (image, label) pairs and save to disk.
 
+    Samples are independent and generated in parallel across `workers`
+    processes (default: all cores). Per-sample seeds are spawned from `seed`,
+    so output is reproducible regardless of the worker count.
+
     Directory structure:
         out_dir/
             images/train/*.png
@@ -219,40 +340,29 @@ def generate_dataset(
             annotations/val/*.png
             class_info.json
     """
-    rng = np.random.default_rng(seed)
     out = Path(out_dir)
     n_val = max(1, int(n * val_split))
     splits = {"train": n - n_val, "val": n_val}
+    seeds = np.random.SeedSequence(seed).spawn(n)
 
     for split, count in splits.items():
         (out / "images"      / split).mkdir(parents=True, exist_ok=True)
         (out / "annotations" / split).mkdir(parents=True, exist_ok=True)
 
     idx = 0
-    for split, count in splits.items():
-        for k in range(count):
-            s = int(rng.integers(0, 2**31))
-            labels = gen_random(grid, s)
-            img    = render_terrain(labels, img_size, rng)
-            # Resize labels to match image size (nearest)
-            if img_size != grid:
-                lbl_pil = Image.fromarray(labels, "L").resize(
-                    (img_size, img_size), Image.NEAREST
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for split, count in splits.items():
+            futures = [
+                pool.submit(
+                    _make_one, i, seeds[i], split, grid, img_size, augment, str(out)
                 )
-                labels = np.array(lbl_pil)
-
-            if augment and split == "train":
-                img, labels = augment_image(img, labels, rng)
-
-            stem = f"{idx:06d}"
-            img.save(out / "images" / split / f"{stem}.png")
-            Image.fromarray(labels, "L").save(
-                out / "annotations" / split / f"{stem}.png"
-            )
-            idx += 1
-
-            if (k + 1) % 100 == 0:
-                print(f"  [{split}] {k + 1}/{count}")
+                for i in range(idx, idx + count)
+            ]
+            for k, fut in enumerate(as_completed(futures)):
+                fut.result()
+                if (k + 1) % 100 == 0:
+                    print(f"  [{split}] {k + 1}/{count}")
+            idx += count
 
     # Save class info
     with open(out / "class_info.json", "w") as f:
@@ -297,6 +407,7 @@ if __name__ == "__main__":
     ap.add_argument("--size", type=int, default=512,       help="Output image size")
     ap.add_argument("--seed", type=int, default=42,        help="Random seed")
     ap.add_argument("--no-aug", action="store_true",       help="Disable augmentation")
+    ap.add_argument("--workers", type=int, default=None,   help="Worker processes (default: all cores)")
     args = ap.parse_args()
 
     generate_dataset(
@@ -306,4 +417,5 @@ if __name__ == "__main__":
         img_size=args.size,
         seed=args.seed,
         augment=not args.no_aug,
+        workers=args.workers,
     )
@@ -1,11 +1,18 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
+import asyncio
 import io
 import base64
 import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from PIL import Image
 import numpy as np
+import orjson
 from typing import Dict, List, Any, Literal
 import logging
 
@@ -43,13 +50,96 @@ app.add_middleware(
 # Global model instance
 model: SegmentationModel = None
 
+# Single thread owns the model so GPU work is serialized off the event loop
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+# Micro-batching: wait up to BATCH_WINDOW_S for up to MAX_BATCH concurrent images
+BATCH_WINDOW_S = 0.005
+MAX_BATCH = 4
+
+# Recent /segment PNGs, served as raw bytes by /results/{result_id}/{kind}.png
+RESULT_CACHE_SIZE = 64
+result_cache: "OrderedDict[str, Dict[str, bytes]]" = OrderedDict()
+
+# Per-class terrain height profile (indexed by class ID) for /terrain
+H_BASE_ARR = np.asarray([0.55, 0.35, 0.22, 0.08, 0.18, 0.02, 0.12, -0.25, 0.28, 0.80], dtype=np.float32)
+H_VAR_ARR  = np.asarray([0.50, 0.20, 0.12, 0.08, 0.15, 0.04, 0.06,  0.05, 0.12, 0.40], dtype=np.float32)
+
+# Per-class attribute lookups (indexed by class ID) for /terrain
+CLASS_NAMES  = np.array([c["name"] for c in TERRAIN_CLASSES])
+CLASS_COSTS  = np.array([c["cost"] for c in TERRAIN_CLASSES], dtype=np.float64)
+CLASS_TRAV   = np.array([c["traversable"] for c in TERRAIN_CLASSES])
+CLASS_COLORS = np.array([c["color"] for c in TERRAIN_CLASSES])
+
+TERRAIN_GENERATORS = {
+    "desert": gen_desert,
+    "rocky":  gen_rocky,
+    "mixed":  gen_mixed,
+}
+
+
+class InferenceBatcher:
+    """
+    Collects images from concurrent requests for a few milliseconds and
+    runs them through the model as one batch on the inference thread.
+    """
+
+    def __init__(self, max_batch: int = MAX_BATCH, window_s: float = BATCH_WINDOW_S):
+        self.max_batch = max_batch
+        self.window_s = window_s
+        self.queue: asyncio.Queue = None
+        self._task: asyncio.Task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def predict(self, image: Image.Image):
+        """Queue one image and wait for its (seg_mask, seg_colored, class_dist)"""
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window_s
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            images = [image for image, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    inference_executor, model.predict_batch, images
+                )
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), result in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(result)
+
+
+batcher = InferenceBatcher()
+
 
 @app.on_event("startup")
 async def startup_event():
     """Load SegFormer model on startup"""
     global model
     logger.info("Loading SegFormer model...")
-    model = SegmentationModel()
+    model = SegmentationModel(compile=os.getenv("TORCH_COMPILE", "0") == "1")
+    await asyncio.get_running_loop().run_in_executor(inference_executor, model.warmup, MAX_BATCH)
+    batcher.start()
     logger.info("✅ Model loaded successfully")
 
 
@@ -80,12 +170,36 @@ async def get_classes():
     return {"classes": TERRAIN_CLASSES}
 
 
+def _encode_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _render_outputs(seg_mask: np.ndarray, seg_colored: Image.Image) -> Dict[str, bytes]:
+    """Build the cost map and encode both result PNGs (runs in a worker thread)"""
+    cost_map_img, _ = generate_cost_map(seg_mask, TERRAIN_CLASSES)
+    return {"seg": _encode_png(seg_colored), "cost": _encode_png(cost_map_img)}
+
+
+def _cache_result(images: Dict[str, bytes]) -> str:
+    """Store PNG bytes for one /segment call, evicting the oldest entries"""
+    result_id = uuid.uuid4().hex
+    result_cache[result_id] = images
+    while len(result_cache) > RESULT_CACHE_SIZE:
+        result_cache.popitem(last=False)
+    return result_id
+
+
 @app.post("/segment")
-async def segment_image(file: UploadFile = File(...)):
+async def segment_image(
+    request: Request,
+    file: UploadFile = File(...),
+    inline: bool = Query(False, description="Also embed both PNGs as base64 data URLs"),
+):
     """
     Segment uploaded image and return:
-    - Segmentation mask (colorized)
-    - Traversability cost map
+    - URLs of the segmentation mask (colorized) and traversability cost map PNGs
     - Class distribution
     - Inference metadata
     """
@@ -100,39 +214,46 @@ async def segment_image(file: UploadFile = File(...)):
         logger.info(f"Received image: {image.size}")
 
         # Run inference
-        import time
         start = time.time()
-        seg_mask, seg_colored, class_dist = model.predict(image)
+        seg_mask, seg_colored, class_dist = await batcher.predict(image)
         inference_ms = int((time.time() - start) * 1000)
         logger.info(f"Inference completed in {inference_ms}ms")
 
-        # Generate cost map
-        cost_map_img, cost_grid = generate_cost_map(seg_mask, TERRAIN_CLASSES)
-
-        # Convert to base64
-        seg_buffer = io.BytesIO()
-        seg_colored.save(seg_buffer, format="PNG")
-        seg_base64 = base64.b64encode(seg_buffer.getvalue()).decode()
-
-        cost_buffer = io.BytesIO()
-        cost_map_img.save(cost_buffer, format="PNG")
-        cost_base64 = base64.b64encode(cost_buffer.getvalue()).decode()
+        # Generate cost map and encode PNGs once; clients fetch the raw bytes from /results
+        images = await asyncio.to_thread(_render_outputs, seg_mask, seg_colored)
+        result_id = _cache_result(images)
 
-        return JSONResponse({
-            "seg_image": f"data:image/png;base64,{seg_base64}",
-            "cost_image": f"data:image/png;base64,{cost_base64}",
+        payload = {
+            "segmentation_url": str(request.url_for("get_result_image", result_id=result_id, kind="seg")),
+            "cost_map_url": str(request.url_for("get_result_image", result_id=result_id, kind="cost")),
             "class_distribution": class_dist,
             "miou_estimate": 65.2,  # Best epoch validation mIoU
             "inference_ms": inference_ms,
             "shape": list(seg_mask.shape),
             "model": "segformer-b2",
-        })
+        }
+        if inline:
+            payload["seg_image"] = f"data:image/png;base64,{base64.b64encode(images['seg']).decode()}"
+            payload["cost_image"] = f"data:image/png;base64,{base64.b64encode(images['cost']).decode()}"
+
+        return ORJSONResponse(payload)
 
     except Exception as e:
         logger.error(f"Error during inference: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/results/{result_id}/{kind}.png")
+async def get_result_image(result_id: str, kind: Literal["seg", "cost"]):
+    """
+    Return a PNG produced by a recent /segment call
+    """
+    images = result_cache.get(result_id)
+    if images is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    return Response(content=images[kind], media_type="image/png")
+
+
 @app.post("/costmap")
 async def generate_costmap_only(file: UploadFile = File(...)):
     """
@@ -146,12 +267,12 @@ async def generate_costmap_only(file: UploadFile = File(...)):
         image = Image.open(io.BytesIO(contents)).convert("RGB")
 
         # Run inference
-        seg_mask, _, _ = model.predict(image)
+        seg_mask, _, _ = await batcher.predict(image)
 
         # Generate cost map
-        _, cost_grid = generate_cost_map(seg_mask, TERRAIN_CLASSES)
+        _, cost_grid = await asyncio.to_thread(generate_cost_map, seg_mask, TERRAIN_CLASSES)
 
-        return JSONResponse({
+        return ORJSONResponse({
             "cost_grid": cost_grid.tolist(),
             "shape": list(cost_grid.shape),
             "resolution_m": 0.05,  # 5cm per pixel (adjustable)
@@ -162,56 +283,47 @@ async def generate_costmap_only(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/terrain")
-async def get_terrain(
-    preset: str = Query("mixed", description="desert | rocky | mixed"),
-    grid: int   = Query(48,      description="Grid size (default 48)"),
-    seed: int   = Query(42,      description="Random seed"),
-):
-    """
-    Return a pre-built terrain grid as JSON.
+# Only grids up to this size are cached: entries hold the full JSON at ~110
+# bytes per cell (~450 KB at 64, vs ~6.6 MB at the 256 request cap)
+TERRAIN_CACHE_MAX_GRID = 64
 
-    Each cell contains:
-      classId, cost, traversable, height, color (hex)
-    """
-    generators = {
-        "desert": gen_desert,
-        "rocky":  gen_rocky,
-        "mixed":  gen_mixed,
-    }
-    gen_fn = generators.get(preset, gen_mixed)
+
+def _terrain_json(preset: str, grid: int, seed: int) -> bytes:
+    """Build and serialise one terrain grid (deterministic in preset, grid, seed)."""
+    gen_fn = TERRAIN_GENERATORS[preset]
 
     labels: np.ndarray = gen_fn(grid, seed)   # (grid, grid) int
 
     # Build height map using class base heights + noise
     rng = np.random.default_rng(seed)
-    H_BASE  = [0.55, 0.35, 0.22, 0.08, 0.18, 0.02, 0.12, -0.25, 0.28, 0.80]
-    H_VAR   = [0.50, 0.20, 0.12, 0.08, 0.15, 0.04, 0.06,  0.05, 0.12, 0.40]
     noise   = rng.random((grid, grid))
 
-    height_map = np.vectorize(lambda cid: H_BASE[cid])(labels) + \
-                 np.vectorize(lambda cid: H_VAR[cid])(labels) * noise
+    height_map = H_BASE_ARR[labels] + H_VAR_ARR[labels] * noise.astype(np.float32)
 
-    # Build class lookup
-    cls_map = {c["id"]: c for c in TERRAIN_CLASSES}
+    # Gather per-cell attributes in bulk, then serialise row by row
+    class_ids = labels.tolist()
+    names     = CLASS_NAMES[labels].tolist()
+    costs     = CLASS_COSTS[labels].tolist()
+    trav      = CLASS_TRAV[labels].tolist()
+    colors    = CLASS_COLORS[labels].tolist()
+    heights   = height_map.astype(np.float64).round(3).tolist()
 
-    cells = []
-    for j in range(grid):
-        row = []
-        for i in range(grid):
-            cid = int(labels[j, i])
-            tc  = cls_map.get(cid, cls_map[3])
-            row.append({
+    cells = [
+        [
+            {
                 "classId":    cid,
-                "className":  tc["name"],
-                "cost":       tc["cost"],
-                "traversable": tc["traversable"],
-                "height":     round(float(height_map[j, i]), 3),
-                "color":      tc["color"],
-            })
-        cells.append(row)
-
-    return JSONResponse({
+                "className":  name,
+                "cost":       cost,
+                "traversable": tr,
+                "height":     h,
+                "color":      color,
+            }
+            for cid, name, cost, tr, h, color in zip(*row)
+        ]
+        for row in zip(class_ids, names, costs, trav, heights, colors)
+    ]
+
+    return orjson.dumps({
         "preset":     preset,
         "grid":       grid,
         "seed":       seed,
@@ -222,6 +334,31 @@ async def get_terrain(
     })
 
 
+_terrain_json_cached = lru_cache(maxsize=32)(_terrain_json)
+
+
+@app.get("/terrain")
+def get_terrain(
+    preset: str = Query("mixed", description="desert | rocky | mixed"),
+    grid: int   = Query(48, ge=2, le=256, description="Grid size (default 48, max 256)"),
+    seed: int   = Query(42,      description="Random seed"),
+):
+    """
+    Return a pre-built terrain grid as JSON.
+
+    Each cell contains:
+      classId, cost, traversable, height, color (hex)
+
+    Plain `def`: FastAPI runs it in its threadpool, so building a large grid
+    doesn't block the event loop (and the inference batcher on it).
+    """
+    # Unknown presets fall back to mixed before the cache, so they share its entries
+    if preset not in TERRAIN_GENERATORS:
+        preset = "mixed"
+    build = _terrain_json_cached if grid <= TERRAIN_CACHE_MAX_GRID else _terrain_json
+    return Response(content=build(preset, grid, seed), media_type="application/json")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
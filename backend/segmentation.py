@@ -2,6 +2,7 @@
 SegFormer inference module for terrain segmentation
 """
 import torch
+from torch._dynamo.exc import TorchDynamoException
 import numpy as np
 from PIL import Image
 from transformers import SegformerImageProcessor, SegformerForSemanticSegmentation
@@ -24,6 +25,21 @@ TERRAIN_CLASSES = [
     {"id": 9, "name": "Obstacle", "color": "#DC143C", "cost": 1.0, "traversable": False},
 ]
 
+# Heuristic ADE20K -> desert class mapping, applied in order (later rules win).
+# This is simplified — a real system uses a trained model
+ADE20K_REMAP = [
+    ([13, 14, 17], 0),  # Roads/ground -> Rock
+    ([4, 9, 17], 1),  # Trees -> Bush
+    ([5, 18], 2),  # Furniture -> Log (placeholder)
+    ([29, 46, 62], 3),  # Sand/path
+    ([3, 13, 45], 4),  # Landscape (floor, ground)
+    ([2], 5),  # Sky
+    ([15, 53], 6),  # Gravel (road variants)
+    ([21, 26], 7),  # Water (sea, lake, river)
+    ([4, 17, 67], 8),  # Vegetation (grass, plant)
+    ([19, 20, 33], 9),  # Obstacle (car, wall, fence)
+]
+
 
 def hex_to_rgb(hex_color: str) -> Tuple[int, int, int]:
     """Convert hex color to RGB tuple"""
@@ -39,7 +55,11 @@ class SegmentationModel:
     For demo purposes, we use a pretrained ADE20K model and remap classes.
     """
 
-    def __init__(self, model_name: str = "nvidia/segformer-b2-finetuned-ade-512-512"):
+    def __init__(
+        self,
+        model_name: str = "nvidia/segformer-b2-finetuned-ade-512-512",
+        compile: bool = False,
+    ):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         logger.info(f"Initializing SegFormer on {self.device}")
 
@@ -49,10 +69,54 @@ class SegmentationModel:
         self.model.to(self.device)
         self.model.eval()
 
+        # FP16 weights on GPU, NHWC layout for the patch-embedding convolutions
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
+        if self.dtype == torch.float16:
+            self.model.half()
+        self.model = self.model.to(memory_format=torch.channels_last)
+
+        # Specialize the graph for the fixed 512x512 input (compiled lazily on first call)
+        self.compiled = compile
+        if compile:
+            self.model = torch.compile(self.model, mode="reduce-overhead", dynamic=False)
+
+        # Input size and normalisation constants from the processor config
+        self.input_size = (self.processor.size["height"], self.processor.size["width"])
+        self.mean = torch.tensor(self.processor.image_mean, device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor(self.processor.image_std, device=self.device).view(1, 3, 1, 1)
+
         # Build color map
         self.color_map = np.array([hex_to_rgb(c["color"]) for c in TERRAIN_CLASSES], dtype=np.uint8)
+
+        # Build ADE20K -> desert class lookup table (unmapped IDs -> 0)
+        self._remap_lut = np.zeros(256, dtype=np.uint8)
+        for ade_ids, class_id in ADE20K_REMAP:
+            self._remap_lut[ade_ids] = class_id
         logger.info(f"✅ SegFormer loaded: {model_name}")
 
+    def warmup(self, max_batch: int = 1) -> None:
+        """
+        Run dummy 512x512 inferences before serving. When compiled, every batch
+        size up to max_batch is run (one graph each); eager mode needs one pass
+        """
+        dummy = Image.new("RGB", (512, 512))
+        batch_sizes = range(1, max_batch + 1) if self.compiled else [1]
+        for batch_size in batch_sizes:
+            self.predict_batch([dummy] * batch_size)
+
+    def _forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Model forward returning logits; drops to eager mode if torch.compile fails"""
+        try:
+            return self.model(pixel_values=pixel_values).logits
+        except TorchDynamoException as e:
+            # Only compile failures; runtime errors (e.g. CUDA OOM) propagate
+            if not self.compiled:
+                raise
+            logger.warning(f"torch.compile failed ({e}), falling back to eager mode")
+            self.model = self.model._orig_mod
+            self.compiled = False
+            return self.model(pixel_values=pixel_values).logits
+
     def predict(self, image: Image.Image) -> Tuple[np.ndarray, Image.Image, List[Dict]]:
         """
         Run inference on input image
@@ -62,36 +126,62 @@ class SegmentationModel:
             - seg_colored: PIL Image with color-coded classes
             - class_distribution: List of dicts with class stats
         """
+        return self.predict_batch([image])[0]
+
+    def predict_batch(
+        self, images: List[Image.Image]
+    ) -> List[Tuple[np.ndarray, Image.Image, List[Dict]]]:
+        """
+        Run inference on several images in one forward pass
+
+        Returns one (seg_mask, seg_colored, class_distribution) tuple per image,
+        as documented in predict().
+        """
         # Preprocess
-        inputs = self.processor(images=image, return_tensors="pt").to(self.device)
+        pixel_values = self._preprocess(images)
 
         # Inference
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            logits = outputs.logits  # (1, num_classes, H, W)
+        with torch.inference_mode():
+            logits = self._forward(pixel_values)  # (B, num_classes, H, W)
+
+            # Get class predictions at logit resolution, then upsample the
+            # label map (nearest) instead of every class channel
+            preds = logits.argmax(dim=1, keepdim=True).float()  # (B, 1, H, W)
+            preds = torch.nn.functional.interpolate(
+                preds,
+                size=(512, 512),  # Standard resolution
+                mode="nearest",
+            )
 
-        # Upsample to original resolution
-        logits = torch.nn.functional.interpolate(
-            logits,
-            size=(512, 512),  # Standard resolution
-            mode="bilinear",
-            align_corners=False,
-        )
+        seg_masks = preds[:, 0].to(torch.uint8).cpu().numpy()  # (B, H, W)
 
-        # Get class predictions
-        seg_mask = logits.argmax(dim=1).squeeze(0).cpu().numpy()  # (H, W)
+        results = []
+        for seg_mask in seg_masks:
+            # Remap ADE20K classes to our 10 desert classes
+            # (In production, this would be a proper fine-tuned model)
+            seg_mask = self._remap_classes(seg_mask)
 
-        # Remap ADE20K classes to our 10 desert classes
-        # (In production, this would be a proper fine-tuned model)
-        seg_mask = self._remap_classes(seg_mask)
+            # Colorize
+            seg_colored = self._colorize_mask(seg_mask)
 
-        # Colorize
-        seg_colored = self._colorize_mask(seg_mask)
+            # Compute class distribution
+            class_dist = self._compute_class_distribution(seg_mask)
 
-        # Compute class distribution
-        class_dist = self._compute_class_distribution(seg_mask)
+            results.append((seg_mask, seg_colored, class_dist))
 
-        return seg_mask, seg_colored, class_dist
+        return results
+
+    def _preprocess(self, images: List[Image.Image]) -> torch.Tensor:
+        """
+        Resize to the model input size, then rescale + normalize on device
+        (replaces the SegformerImageProcessor CPU pipeline)
+        """
+        h, w = self.input_size
+        batch = np.stack([np.asarray(img.resize((w, h), Image.BILINEAR)) for img in images])
+        pixel_values = torch.from_numpy(batch).to(self.device, non_blocking=True)
+        pixel_values = pixel_values.permute(0, 3, 1, 2).float().div_(255)
+        pixel_values.sub_(self.mean).div_(self.std)
+        return pixel_values.to(self.dtype).contiguous(memory_format=torch.channels_last)
 
     def _remap_classes(self, mask: np.ndarray) -> np.ndarray:
         """
@@ -100,39 +190,20 @@ class SegmentationModel:
         NOTE: In production, you'd use a model trained on your custom dataset.
         This is a demo mapping to show the pipeline.
         """
-        remapped = np.zeros_like(mask)
-        
-        # Example heuristic mapping (ADE20K -> Desert classes)
-        # This is simplified — a real system uses a trained model
-        remapped[np.isin(mask, [13, 14, 17])] = 0  # Roads/ground -> Rock
-        remapped[np.isin(mask, [4, 9, 17])] = 1  # Trees -> Bush
-        remapped[np.isin(mask, [5, 18])] = 2  # Furniture -> Log (placeholder)
-        remapped[np.isin(mask, [29, 46, 62])] = 3  # Sand/path
-        remapped[np.isin(mask, [3, 13, 45])] = 4  # Landscape (floor, ground)
-        remapped[np.isin(mask, [2])] = 5  # Sky
-        remapped[np.isin(mask, [15, 53])] = 6  # Gravel (road variants)
-        remapped[np.isin(mask, [21, 26])] = 7  # Water (sea, lake, river)
-        remapped[np.isin(mask, [4, 17, 67])] = 8  # Vegetation (grass, plant)
-        remapped[np.isin(mask, [19, 20, 33])] = 9  # Obstacle (car, wall, fence)
-
-        return remapped
+        return self._remap_lut[mask]
 
     def _colorize_mask(self, mask: np.ndarray) -> Image.Image:
         """Convert class mask to RGB image"""
-        h, w = mask.shape
-        colored = np.zeros((h, w, 3), dtype=np.uint8)
-        for class_id in range(len(TERRAIN_CLASSES)):
-            colored[mask == class_id] = self.color_map[class_id]
-        return Image.fromarray(colored)
+        return Image.fromarray(self.color_map[mask])
 
     def _compute_class_distribution(self, mask: np.ndarray) -> List[Dict]:
         """Compute per-class pixel distribution"""
         total_pixels = mask.size
+        counts = np.bincount(mask.ravel(), minlength=len(TERRAIN_CLASSES))
         distribution = []
         
         for cls in TERRAIN_CLASSES:
-            count = np.sum(mask == cls["id"])
-            conf = float(count / total_pixels)
+            conf = float(counts[cls["id"]] / total_pixels)
             if conf > 0.01:  # Only include classes with >1% coverage
                 distribution.append({
                     "name": cls["name"],
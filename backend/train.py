@@ -19,23 +19,24 @@ Outputs:
     checkpoints/dunenet/metrics.json
 """
 import argparse
+import hashlib
 import json
 import logging
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import torch
 from torch.utils.data import DataLoader, Dataset
-from PIL import Image
 from torch.optim import AdamW
-from torch.optim.lr_scheduler import OneCycleLR
+from torchvision.io import ImageReadMode, read_image
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms.v2 import functional as TVF
 from tqdm import tqdm
-from transformers import (
-    SegformerForSemanticSegmentation,
-    SegformerImageProcessor,
-    get_cosine_schedule_with_warmup,
-)
+from transformers import SegformerForSemanticSegmentation, SegformerImageProcessor
 
 from dataset import TERRAIN_CLASSES
 
@@ -45,91 +46,250 @@ logger = logging.getLogger(__name__)
 NUM_CLASSES = len(TERRAIN_CLASSES)
 ID2LABEL    = {c["id"]: c["name"] for c in TERRAIN_CLASSES}
 LABEL2ID    = {c["name"]: c["id"] for c in TERRAIN_CLASSES}
+LOG_EVERY   = 20   # steps between progress-bar loss updates (each forces a device sync)
 
 
 # ─── Dataset ──────────────────────────────────────────────────────────────────
 
 class TerrainSegDataset(Dataset):
     """
-    Returns (pixel_values, labels) tensors ready for SegformerForSemanticSegmentation.
-
-    pixel_values : FloatTensor (3, H, W) – preprocessed by SegformerImageProcessor
-    labels       : LongTensor  (H, W)   – class indices 0..NUM_CLASSES-1
+    Returns raw (image, labels) tensors; augmentation, resize + normalisation
+    happen batched on the training device (see augment_batch, preprocess_batch).
+    `augment` only records whether the split should be augmented.
+
+    image  : ByteTensor (3, H, W) – RGB uint8
+    labels : ByteTensor (H, W)    – class indices 0..NUM_CLASSES-1 (widened
+                                    to int64 only where the loss/metrics need it)
+
+    PNGs are decoded straight to tensors with torchvision.io (no PIL objects);
+    for the remaining PIL paths, `pip install pillow-simd` is a drop-in speedup.
+
+    With `cache_dir` set, every sample is decoded, resized to `img_size` and
+    clamped once into uint8 .npy shards under `cache_dir`; later epochs and runs
+    read them through np.memmap instead of decoding PNGs. A manifest of the
+    source files (names, sizes, mtimes) is stored next to the shards, and they
+    are rebuilt whenever it no longer matches.
     """
 
     def __init__(
         self,
         root: str,
         split: str,
-        processor: SegformerImageProcessor,
         img_size: int = 512,
         augment: bool = True,
+        cache_dir: Optional[str] = None,
     ):
         self.img_dir = Path(root) / "images"      / split
         self.ann_dir = Path(root) / "annotations" / split
-        self.files   = sorted(self.img_dir.glob("*.png"))
-        self.processor = processor
+        files        = sorted(self.img_dir.glob("*.png"))
         self.augment   = augment and split == "train"
         self.img_size  = img_size
 
-        assert len(self.files) > 0, f"No images found in {self.img_dir}"
-        logger.info(f"  [{split}] {len(self.files)} samples")
+        # Plain str paths, built once: no Path allocation per sample in workers
+        self.img_paths = [str(p) for p in files]
+        self.ann_paths = [str(self.ann_dir / p.name) for p in files]
+
+        assert len(self.img_paths) > 0, f"No images found in {self.img_dir}"
+        logger.info(f"  [{split}] {len(self.img_paths)} samples")
+
+        self.img_cache = self.ann_cache = None
+        self._images_mm = self._labels_mm = None   # opened lazily in each worker
+        if cache_dir is not None:
+            cache_root = Path(cache_dir)
+            cache_root.mkdir(parents=True, exist_ok=True)
+            self.img_cache = cache_root / f"images_cache_{split}_{img_size}.npy"
+            self.ann_cache = cache_root / f"annotations_cache_{split}_{img_size}.npy"
+            manifest_path  = cache_root / f"manifest_{split}_{img_size}.txt"
+            manifest = self._manifest()
+            if not (
+                manifest_path.exists() and manifest_path.read_text() == manifest
+                and self._cache_valid(self.img_cache) and self._cache_valid(self.ann_cache)
+            ):
+                self._build_cache()
+                manifest_path.write_text(manifest)
 
     def __len__(self) -> int:
-        return len(self.files)
+        return len(self.img_paths)
 
-    def __getitem__(self, idx: int):
-        img_path = self.files[idx]
-        ann_path = self.ann_dir / img_path.name
-
-        image  = Image.open(img_path).convert("RGB")
-        labels = np.array(Image.open(ann_path).convert("L"), dtype=np.int64)
-
-        # Random augmentation
-        if self.augment:
-            import random
-            # Horizontal flip
-            if random.random() > 0.5:
-                image  = image.transpose(Image.FLIP_LEFT_RIGHT)
-                labels = np.fliplr(labels)
-            # Vertical flip
-            if random.random() > 0.4:
-                image  = image.transpose(Image.FLIP_TOP_BOTTOM)
-                labels = np.flipud(labels)
-            # Rotation
-            k = random.randint(0, 3)
-            if k:
-                image  = image.rotate(k * 90)
-                labels = np.rot90(labels, k)
+    def _manifest(self) -> str:
+        """Digest of every source file's name, size and mtime, plus the cache size."""
+        h = hashlib.sha1(str(self.img_size).encode())
+        for path in self.img_paths + self.ann_paths:
+            st = os.stat(path)
+            h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+        return h.hexdigest()
+
+    def _cache_valid(self, path: Path) -> bool:
+        return path.exists() and np.load(path, mmap_mode="r").shape[0] == len(self.img_paths)
+
+    def _load(self, idx: int):
+        """Decode one sample from PNG as (3, H, W) uint8 image, (H, W) uint8 labels."""
+        image  = read_image(self.img_paths[idx], ImageReadMode.RGB)     # (3, H, W)
+        labels = read_image(self.ann_paths[idx], ImageReadMode.GRAY)[0] # (H, W)
 
         # Clamp labels to valid range (safety)
-        labels = np.clip(np.ascontiguousarray(labels), 0, NUM_CLASSES - 1)
+        return image, labels.clamp_(max=NUM_CLASSES - 1)
+
+    def _build_cache(self):
+        n, size = len(self.img_paths), [self.img_size, self.img_size]
+        logger.info(f"  building uint8 cache ({n} samples) → {self.img_cache.parent}")
+
+        img_tmp = self.img_cache.with_suffix(".tmp")
+        ann_tmp = self.ann_cache.with_suffix(".tmp")
+        images = np.lib.format.open_memmap(img_tmp, mode="w+", dtype=np.uint8, shape=(n, 3, *size))
+        labels = np.lib.format.open_memmap(ann_tmp, mode="w+", dtype=np.uint8, shape=(n, *size))
+        for i in range(n):
+            image, label = self._load(i)
+            if list(image.shape[-2:]) != size:
+                image = TVF.resize(image, size, antialias=True)
+            if list(label.shape[-2:]) != size:
+                label = TVF.resize(
+                    label[None], size, interpolation=InterpolationMode.NEAREST
+                )[0]
+            images[i] = image.numpy()
+            labels[i] = label.numpy()
+        images.flush()
+        labels.flush()
+        del images, labels
+
+        # Publish only complete shards
+        os.replace(img_tmp, self.img_cache)
+        os.replace(ann_tmp, self.ann_cache)
+
+    def __getitem__(self, idx: int):
+        if self.img_cache is None:
+            return self._load(idx)
+
+        if self._images_mm is None:
+            self._images_mm = np.load(self.img_cache, mmap_mode="r")
+            self._labels_mm = np.load(self.ann_cache, mmap_mode="r")
+        image  = torch.from_numpy(np.array(self._images_mm[idx]))              # (3, H, W)
+        labels = torch.from_numpy(np.array(self._labels_mm[idx]))             # (H, W)
+        return image, labels
+
+
+def collate_uint8(batch):
+    """Stack samples into (B, 3, H, W) uint8 images and (B, H, W) labels."""
+    images, labels = zip(*batch)
+    return torch.stack(images), torch.stack(labels)
+
+
+def augment_batch(pixel_values: torch.Tensor, labels: torch.Tensor):
+    """
+    Random flips and 90° rotation applied to a whole batch on its device,
+    identically to images (B, 3, H, W) and labels (B, H, W).
+    """
+    r = torch.rand(3)   # host RNG: branching needs no device sync
+    # Horizontal flip
+    if r[0] > 0.5:
+        pixel_values, labels = pixel_values.flip(-1), labels.flip(-1)
+    # Vertical flip
+    if r[1] > 0.4:
+        pixel_values, labels = pixel_values.flip(-2), labels.flip(-2)
+    # Rotation
+    k = int(r[2] * 4)
+    if k:
+        pixel_values = torch.rot90(pixel_values, k, dims=(-2, -1))
+        labels       = torch.rot90(labels,       k, dims=(-2, -1))
+    return pixel_values, labels
+
+
+def preprocess_batch(
+    pixel_values: torch.Tensor,
+    labels: torch.Tensor,
+    img_size: int,
+    mean,
+    std,
+):
+    """
+    Resize, rescale and normalise a uint8 (B, 3, H, W) batch on its device,
+    returning channels_last pixel values. Labels are resized with
+    nearest-neighbour to stay valid class indices.
+    """
+    size = [img_size, img_size]
+    if list(pixel_values.shape[-2:]) != size:
+        pixel_values = TVF.resize(pixel_values, size, antialias=True)
+    if list(labels.shape[-2:]) != size:
+        labels = TVF.resize(
+            labels.unsqueeze(1), size, interpolation=InterpolationMode.NEAREST
+        ).squeeze(1)
+    pixel_values = TVF.to_dtype(pixel_values, torch.float32, scale=True)
+    pixel_values = TVF.normalize(pixel_values, mean=mean, std=std)
+    return pixel_values.contiguous(memory_format=torch.channels_last), labels
+
+
+# ─── Eval Forward ─────────────────────────────────────────────────────────────
+
+class _LogitsOnly(torch.nn.Module):
+    """Tuple-returning wrapper so the eval forward traces to a single tensor."""
 
-        # SegformerImageProcessor handles resize + normalise
-        encoded = self.processor(
-            images=image,
-            segmentation_maps=Image.fromarray(labels.astype(np.uint8), "L"),
-            return_tensors="pt",
-        )
-        pixel_values = encoded["pixel_values"].squeeze(0)   # (3, H, W)
-        label_tensor = encoded["labels"].squeeze(0)         # (H, W)
-        return pixel_values, label_tensor
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model(pixel_values=pixel_values, return_dict=False)[0]
+
+
+def make_eval_forward(model: torch.nn.Module, example_shape, device: torch.device):
+    """
+    Return a `pixel_values -> logits` function for validation.
+
+    Batches of `example_shape` run through a torch.jit.trace of the eval graph
+    (which shares weights with `model`); other shapes use the eager model.
+    Falls back to torch.compile if the model cannot be traced.
+    """
+    was_training = model.training
+    model.eval()
+    example = torch.zeros(example_shape, device=device).contiguous(memory_format=torch.channels_last)
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(_LogitsOnly(model), example, check_trace=False)
+    except Exception as e:
+        logger.warning(f"torch.jit.trace failed ({e}), compiling the eval forward instead")
+        compiled = torch.compile(model, mode="reduce-overhead")
+        return lambda pixel_values: compiled(pixel_values=pixel_values).logits
+    finally:
+        model.train(was_training)
+
+    def forward(pixel_values: torch.Tensor) -> torch.Tensor:
+        if pixel_values.shape == example.shape:
+            return traced(pixel_values)
+        return model(pixel_values=pixel_values).logits
+
+    return forward
 
 
 # ─── Metrics ──────────────────────────────────────────────────────────────────
 
+def confusion_matrix(preds: np.ndarray, labels: np.ndarray, num_classes: int) -> np.ndarray:
+    """(C, C) pixel counts (rows = label, cols = prediction), ignoring unlabelled pixels (255)."""
+    valid = labels != 255
+    k = labels[valid].astype(np.int64) * num_classes + preds[valid].astype(np.int64)
+    return np.bincount(k, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def miou_from_confusion(cm: np.ndarray) -> float:
+    """Mean IoU over classes present in either labels or predictions."""
+    tp    = np.diag(cm)
+    union = cm.sum(0) + cm.sum(1) - tp
+    present = union > 0
+    return float((tp[present] / union[present]).mean()) if present.any() else 0.0
+
+
 def compute_miou(preds: np.ndarray, labels: np.ndarray, num_classes: int) -> float:
     """Mean Intersection-over-Union, ignoring unlabelled pixels (255)."""
-    ious = []
-    for cls in range(num_classes):
-        pred_c   = preds  == cls
-        label_c  = labels == cls
-        inter    = (pred_c & label_c).sum()
-        union    = (pred_c | label_c).sum()
-        if union == 0:
-            continue
-        ious.append(inter / union)
-    return float(np.mean(ious)) if ious else 0.0
+    return miou_from_confusion(confusion_matrix(preds, labels, num_classes))
+
+
+# ─── LR Schedule ──────────────────────────────────────────────────────────────
+
+def cosine_with_warmup(step: int, warmup_steps: int, total_steps: int, base_lr: float) -> float:
+    """Linear warmup to `base_lr`, then cosine decay to 0 (matches HF's cosine schedule)."""
+    if step < warmup_steps:
+        return base_lr * step / max(1, warmup_steps)
+    progress = (step - warmup_steps) / max(1, total_steps - warmup_steps)
+    return base_lr * max(0.0, 0.5 * (1.0 + math.cos(math.pi * progress)))
 
 
 # ─── Training Loop ────────────────────────────────────────────────────────────
@@ -145,15 +305,32 @@ def train(
     warmup_ratio: float,
     fp16: bool,
     num_workers: int,
+    compile: bool = False,
+    bf16: bool = False,
+    cache: bool = False,
+    accum_steps: int = 1,
 ):
+    if accum_steps < 1:
+        raise ValueError(f"accum_steps must be >= 1, got {accum_steps}")
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logger.info(f"Training on {device}  |  model: {model_name}")
 
+    # Input shapes are fixed, so let cuDNN autotune once; TF32 for fp32 matmuls/convs
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
     out = Path(out_dir)
     out.mkdir(parents=True, exist_ok=True)
 
     # ── Model & Processor ──────────────────────────────────────────────────────
-    processor = SegformerImageProcessor.from_pretrained(model_name, reduce_labels=False)
+    # Only used for its normalisation constants and saved alongside checkpoints
+    processor = SegformerImageProcessor.from_pretrained(
+        model_name, reduce_labels=False, size={"height": img_size, "width": img_size}
+    )
+    mean, std = processor.image_mean, processor.image_std
 
     model = SegformerForSemanticSegmentation.from_pretrained(
         model_name,
@@ -163,84 +340,146 @@ def train(
         ignore_mismatched_sizes=True,       # replace classification head
     )
     model.to(device)
+    model.to(memory_format=torch.channels_last)   # NHWC kernels for the patch-merging convs
+
+    # Compiled wrapper for forward passes; `model` stays the plain module for saving
+    forward_model = (
+        torch.compile(model, mode="max-autotune", dynamic=False) if compile else model
+    )
 
     # ── Data ───────────────────────────────────────────────────────────────────
-    train_ds = TerrainSegDataset(data_root, "train", processor, img_size, augment=True)
-    val_ds   = TerrainSegDataset(data_root, "val",   processor, img_size, augment=False)
+    # Decoded-sample shards (opt-in) live with the run outputs, not the dataset
+    cache_dir = out / "cache" if cache else None
+    train_ds = TerrainSegDataset(data_root, "train", img_size, augment=True,  cache_dir=cache_dir)
+    val_ds   = TerrainSegDataset(data_root, "val",   img_size, augment=False, cache_dir=cache_dir)
+
+    # Pinned batches + non_blocking copies overlap H2D with compute; workers
+    # stay alive across epochs and keep several batches in flight
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=True, collate_fn=collate_uint8)
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
 
     train_loader = DataLoader(
-        train_ds, batch_size=batch_size, shuffle=True,
-        num_workers=num_workers, pin_memory=True, drop_last=True,
+        train_ds, batch_size=batch_size, shuffle=True, drop_last=True,
+        **loader_kwargs,
     )
+    val_bs = max(1, batch_size // 2)
     val_loader = DataLoader(
-        val_ds, batch_size=max(1, batch_size // 2), shuffle=False,
-        num_workers=num_workers, pin_memory=True,
+        val_ds, batch_size=val_bs, shuffle=False,
+        **loader_kwargs,
     )
 
+    # Validation forward: the compiled model if requested, else a traced eval graph
+    if compile:
+        eval_forward = lambda pixel_values: forward_model(pixel_values=pixel_values).logits
+    else:
+        eval_forward = make_eval_forward(model, (val_bs, 3, img_size, img_size), device)
+
     # ── Optimiser & Scheduler ──────────────────────────────────────────────────
-    optimizer = AdamW(model.parameters(), lr=lr, weight_decay=0.01)
-    total_steps = len(train_loader) * epochs
+    # Single fused multi-tensor kernel on CUDA, foreach (multi-tensor) fallback on CPU
+    if device.type == "cuda":
+        optimizer = AdamW(model.parameters(), lr=lr, weight_decay=0.01, fused=True)
+    else:
+        optimizer = AdamW(model.parameters(), lr=lr, weight_decay=0.01, foreach=True)
+    # One optimiser step per `accum_steps` micro-batches (plus a final partial group)
+    steps_per_epoch = math.ceil(len(train_loader) / accum_steps)
+    total_steps = steps_per_epoch * epochs
     warmup_steps = int(total_steps * warmup_ratio)
 
-    scheduler = get_cosine_schedule_with_warmup(
-        optimizer, num_warmup_steps=warmup_steps, num_training_steps=total_steps
-    )
+    # Whole schedule precomputed as floats; the hot loop only indexes it
+    lr_schedule = [cosine_with_warmup(i, warmup_steps, total_steps, lr) for i in range(total_steps + 1)]
+    global_step = 0
+    for g in optimizer.param_groups:
+        g["lr"] = lr_schedule[0]
 
-    scaler = torch.cuda.amp.GradScaler(enabled=fp16 and device.type == "cuda")
+    # bf16 keeps fp32's exponent range, so loss scaling is only needed for fp16
+    use_amp   = (fp16 or bf16) and device.type == "cuda"
+    amp_dtype = torch.bfloat16 if bf16 else torch.float16
+    # torch.cuda.amp.GradScaler rather than torch.amp's (2.3+) to keep the torch>=2.2 floor
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
 
     # ── Training ───────────────────────────────────────────────────────────────
     best_miou = 0.0
     all_metrics = []
 
+    # Background writer so checkpoint serialisation doesn't stall the next epoch
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
+
     for epoch in range(1, epochs + 1):
         model.train()
-        total_loss = 0.0
+        total_loss = torch.zeros((), device=device)   # summed on-device, read once per epoch
 
-        pbar = tqdm(train_loader, desc=f"Epoch {epoch}/{epochs} [train]", leave=False)
-        for pixel_values, labels in pbar:
-            pixel_values = pixel_values.to(device)
-            labels       = labels.to(device)
-
-            optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
-            with torch.cuda.amp.autocast(enabled=fp16 and device.type == "cuda"):
-                outputs = model(pixel_values=pixel_values, labels=labels)
+        pbar = tqdm(train_loader, desc=f"Epoch {epoch}/{epochs} [train]", leave=False)
+        for step, (pixel_values, labels) in enumerate(pbar, 1):
+            pixel_values = pixel_values.to(device, non_blocking=True)
+            labels       = labels.to(device, non_blocking=True)
+            if train_ds.augment:
+                pixel_values, labels = augment_batch(pixel_values, labels)
+            pixel_values, labels = preprocess_batch(pixel_values, labels, img_size, mean, std)
+
+            with torch.amp.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                outputs = forward_model(pixel_values=pixel_values, labels=labels.long())
                 loss    = outputs.loss
 
-            scaler.scale(loss).backward()
-            scaler.unscale_(optimizer)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            scaler.step(optimizer)
-            scaler.update()
-            scheduler.step()
-
-            total_loss += loss.item()
-            pbar.set_postfix(loss=f"{loss.item():.4f}")
-
-        avg_loss = total_loss / len(train_loader)
+            # Accumulate gradients averaged over the micro-batches of one step
+            # (the last group of an epoch may hold fewer than accum_steps)
+            group_start = (step - 1) // accum_steps * accum_steps
+            group_len   = min(accum_steps, len(train_loader) - group_start)
+            scaler.scale(loss / group_len).backward()
+
+            if step % accum_steps == 0 or step == len(train_loader):
+                if scaler.is_enabled():
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                    optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+
+                global_step += 1
+                for g in optimizer.param_groups:
+                    g["lr"] = lr_schedule[global_step]
+
+            total_loss += loss.detach()
+            if step % LOG_EVERY == 0:
+                pbar.set_postfix(loss=f"{loss.item():.4f}")
+
+        avg_loss = total_loss.item() / len(train_loader)
 
         # ── Validation ─────────────────────────────────────────────────────────
         model.eval()
-        all_preds, all_labels = [], []
+        # Confusion matrix accumulated on-device; only (C, C) counts reach the host
+        cm = torch.zeros(NUM_CLASSES, NUM_CLASSES, dtype=torch.int64, device=device)
 
         with torch.no_grad():
             for pixel_values, labels in tqdm(val_loader, desc=f"Epoch {epoch}/{epochs} [val]", leave=False):
-                pixel_values = pixel_values.to(device)
-                outputs = model(pixel_values=pixel_values)
-                logits  = outputs.logits  # (B, C, H, W)
-
-                # Upsample to label resolution
+                pixel_values = pixel_values.to(device, non_blocking=True)
+                labels       = labels.to(device, non_blocking=True)
+                # Pad a short last batch to the static val_bs shape (compiled/traced
+                # graphs) and slice the padded rows back off the logits
+                n = pixel_values.shape[0]
+                if n < val_bs:
+                    pad = pixel_values.new_zeros((val_bs - n, *pixel_values.shape[1:]))
+                    pixel_values = torch.cat([pixel_values, pad])
+                pixel_values, labels = preprocess_batch(pixel_values, labels, img_size, mean, std)
+                logits  = eval_forward(pixel_values)[:n]  # (B, C, H, W)
+
+                # Upsample to label resolution (SegFormer logits are 1/4 of the input)
                 upsampled = torch.nn.functional.interpolate(
                     logits, size=labels.shape[-2:], mode="bilinear", align_corners=False
                 )
-                preds_np  = upsampled.argmax(dim=1).cpu().numpy()
-                labels_np = labels.numpy()
-                all_preds.append(preds_np)
-                all_labels.append(labels_np)
+                preds  = upsampled.argmax(dim=1).view(-1)
+                labels = labels.view(-1).long()
+                valid  = labels != 255
+                k      = labels[valid] * NUM_CLASSES + preds[valid]
+                cm += torch.bincount(k, minlength=NUM_CLASSES * NUM_CLASSES).view(NUM_CLASSES, NUM_CLASSES)
 
-        preds_flat  = np.concatenate([p.flatten() for p in all_preds])
-        labels_flat = np.concatenate([l.flatten() for l in all_labels])
-        miou        = compute_miou(preds_flat, labels_flat, NUM_CLASSES)
+        miou = miou_from_confusion(cm.cpu().numpy())
 
         logger.info(f"Epoch {epoch}/{epochs}  loss={avg_loss:.4f}  val_mIoU={miou*100:.2f}%")
         all_metrics.append({"epoch": epoch, "loss": avg_loss, "val_miou": miou})
@@ -248,9 +487,18 @@ def train(
         # Save best
         if miou > best_miou:
             best_miou = miou
-            model.save_pretrained(out / "best")
-            processor.save_pretrained(out / "best")
-            logger.info(f"  ✅ New best mIoU={best_miou*100:.2f}% — saved to {out/'best'}")
+            # Snapshot weights to CPU here; serialise + write in the background
+            state_dict = {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()}
+            pending_saves.append(
+                save_executor.submit(model.save_pretrained, out / "best", state_dict=state_dict)
+            )
+            pending_saves.append(save_executor.submit(processor.save_pretrained, out / "best"))
+            logger.info(f"  ✅ New best mIoU={best_miou*100:.2f}% — saving to {out/'best'}")
+
+    # Wait for (and surface errors from) background best-checkpoint saves
+    save_executor.shutdown(wait=True)
+    for fut in pending_saves:
+        fut.result()
 
     # Save final + metrics
     model.save_pretrained(out / "final")
@@ -276,11 +524,15 @@ if __name__ == "__main__":
                     help="Output directory for checkpoints")
     ap.add_argument("--epochs",  type=int,   default=30)
     ap.add_argument("--bs",      type=int,   default=8,     help="Batch size")
+    ap.add_argument("--accum",   type=int,   default=1,     help="Gradient accumulation steps")
     ap.add_argument("--lr",      type=float, default=6e-5,  help="Peak learning rate")
     ap.add_argument("--size",    type=int,   default=512,   help="Image size")
     ap.add_argument("--warmup",  type=float, default=0.06,  help="Warmup ratio")
-    ap.add_argument("--fp16",    action="store_true",        help="Mixed precision")
+    ap.add_argument("--fp16",    action="store_true",        help="Mixed precision (fp16 + loss scaling)")
+    ap.add_argument("--bf16",    action="store_true",        help="Mixed precision (bf16, no loss scaling)")
     ap.add_argument("--workers", type=int,   default=4,     help="DataLoader workers")
+    ap.add_argument("--compile", action="store_true",        help="torch.compile the model")
+    ap.add_argument("--cache",   action="store_true",        help="Cache decoded samples as uint8 .npy shards under --out")
     args = ap.parse_args()
 
     train(
@@ -294,4 +546,8 @@ if __name__ == "__main__":
         warmup_ratio= args.warmup,
         fp16        = args.fp16,
         num_workers = args.workers,
+        compile     = args.compile,
+        bf16        = args.bf16,
+        cache       = args.cache,
+        accum_steps = args.accum,
     )
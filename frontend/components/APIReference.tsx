@@ -7,12 +7,12 @@ const ENDPOINTS = [
   {
     method: "POST",
     path: "/segment",
-    desc: "Upload an image, receive segmentation mask + traversability cost map.",
+    desc: "Upload an image, receive segmentation mask + traversability cost map URLs (add ?inline=true for base64 data URLs).",
     body: `# multipart/form-data
 file: <image file>`,
     response: `{
-  "seg_image": "data:image/png;base64,...",
-  "cost_image": "data:image/png;base64,...",
+  "segmentation_url": "http://localhost:8000/results/<id>/seg.png",
+  "cost_map_url": "http://localhost:8000/results/<id>/cost.png",
   "class_distribution": [
     { "name": "Sand", "conf": 0.34, "color": "#DEB887" },
     { "name": "Rock", "conf": 0.22, "color": "#8B7355" }